@@ -1 +1,9 @@
-from .switcher import *
\ No newline at end of file
+from .switcher import *
+
+
+def __getattr__(name):
+    """Expose `litellm` lazily so importing mooch does not pay its import cost"""
+    if name == 'litellm':
+        import litellm
+        return litellm
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,131 +1,1205 @@
+import sys
+import json
+import math
+import time
+import random
+import asyncio
+import heapq
+import hashlib
+import itertools
+import logging
+import operator
+import functools
+import httpx
 import openai
-import litellm
-from typing import List, Union, Callable
+import pydantic
+import weakref
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from types import SimpleNamespace
+from collections import OrderedDict
+from typing import Any, Dict, List, Set, Tuple, Type, Union, Callable, ClassVar, Optional, NamedTuple
+
+
+logger = logging.getLogger("mooch")
+
+# Verbose calls log here instead: straight to stdout, never through the application's handlers
+_verbose_logger = logging.getLogger("mooch.verbose")
+_verbose_logger.propagate = False
+
+# Whether the call currently being switched came from a verbose wrapper; asyncio-task safe
+_verbose_var: "contextvars.ContextVar[bool]" = contextvars.ContextVar("mooch_verbose", default=False)
+
+
+def _enable_verbose_logging():
+    """Show switching logs of verbose wrappers on stdout (idempotent)"""
+    _verbose_logger.setLevel(logging.DEBUG)
+    if not any(getattr(handler, '_mooch', False) for handler in _verbose_logger.handlers):
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        handler._mooch = True
+        _verbose_logger.addHandler(handler)
+
+
+def _debug(msg: str, *args):
+    """Log a switching message for the current call: on stdout if it is verbose, else on the "mooch" logger"""
+    (_verbose_logger if _verbose_var.get() else logger).debug(msg, *args)
+
+
+class AllKeysExhaustedError(Exception):
+    """Raised when every API key is rate limited; the last rate limit error is its __cause__"""
+    
+    def __init__(self, per_key: Dict[str, Exception], next_retry: Optional[float] = None, n_keys: Optional[int] = None):
+        message = f"All {len(per_key) if n_keys is None else n_keys} API keys are rate limited"
+        if next_retry is not None:
+            message += f", retry in {next_retry:.1f}s"
+        super().__init__(message)
+        # Last rate limit error of each key tried, and seconds until the first key's cooldown ends
+        self.per_key = per_key
+        self.next_retry = next_retry
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """Seconds advised by the Retry-After (or retry-after-ms) header of a rate limit error, if present"""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or getattr(error, 'litellm_response_headers', None)
+    if not headers:
+        return None
+    try:
+        if headers.get('retry-after-ms') is not None:
+            return float(headers.get('retry-after-ms')) / 1000
+        return float(headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+def _running_loop() -> Optional[asyncio.AbstractEventLoop]:
+    """The event loop running in this thread, or None outside of one"""
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+def _is_deterministic(request: Dict[str, Any]) -> bool:
+    """Whether a request's response can be reused (non-streaming with temperature=0)"""
+    # temperature may also be None or openai.NOT_GIVEN, which are not cacheable
+    temperature = request.get('temperature')
+    return not request.get('stream') and isinstance(temperature, (int, float)) and temperature <= 0
+
+
+class _KeyLabels(NamedTuple):
+    """Per-key log messages, indexed like the api_keys they were built from"""
+    trying: Tuple[str, ...]
+    success: Tuple[str, ...]
+    rate_limited: Tuple[str, ...]
+
+
+@functools.lru_cache(maxsize=32)
+def _key_labels(api_keys: Tuple[str, ...]) -> _KeyLabels:
+    """Format the log messages for a set of keys once instead of on every call"""
+    n_keys = len(api_keys)
+    return _KeyLabels(
+        tuple(f"[Mooch] Trying API key {i + 1}/{n_keys}: {api_key[:10]}..." for i, api_key in enumerate(api_keys)),
+        tuple(f"[Mooch] ✓ Success with API key {i + 1}" for i in range(n_keys)),
+        tuple(f"[Mooch] ✗ Rate limit hit with API key {i + 1}" for i in range(n_keys)),
+    )
+
+
+def _dump_response(response: Any) -> Optional[str]:
+    """Serialise an OpenAI/LiteLLM response model to JSON tagged with its type, or None if it is not one"""
+    cls = type(response)
+    if not isinstance(response, pydantic.BaseModel) or cls.__module__.split('.')[0] not in ('openai', 'litellm'):
+        return None
+    return json.dumps({'type': f"{cls.__module__}:{cls.__qualname__}", 'data': json.loads(response.model_dump_json())})
+
+
+def _load_response(raw: Union[str, bytes]) -> Any:
+    """Rebuild a response stored by _dump_response; only already imported OpenAI/LiteLLM models are accepted"""
+    payload = json.loads(raw)
+    module_name, _, qualname = payload['type'].partition(':')
+    module = sys.modules.get(module_name) if module_name.split('.')[0] in ('openai', 'litellm') else None
+    cls = functools.reduce(getattr, qualname.split('.'), module) if module is not None else None
+    if not (isinstance(cls, type) and issubclass(cls, pydantic.BaseModel)):
+        raise ValueError(f"Refusing to load cached response of type {payload['type']!r}")
+    return cls.model_validate(payload['data'])
+
+
+def _cosine(a: List[float], b: List[float]) -> float:
+    """Cosine similarity of two vectors"""
+    dot = sum(map(operator.mul, a, b))
+    norm = math.sqrt(sum(map(operator.mul, a, a)) * sum(map(operator.mul, b, b)))
+    return dot / norm if norm else 0.0
+
+
+class SemanticLLMCache:
+    """Embedding-based response cache that also matches paraphrased prompts"""
+
+    def __init__(
+        self,
+        embedder: Callable[[str], List[float]],
+        threshold: float = 0.85,
+        maxsize: int = 1024,
+    ):
+        """
+        Initialize SemanticLLMCache
+        
+        Args:
+            embedder: Function turning a text into an embedding vector
+            threshold: Minimum cosine similarity for a cached response to be reused
+            maxsize: Maximum number of responses kept (oldest evicted first)
+        """
+        self.threshold = threshold
+        self.maxsize = maxsize
+        # get() and the set() after a miss embed the same text; remember recent embeddings
+        self._embed = functools.lru_cache(maxsize=128)(embedder)
+        self._entries: List[Tuple[str, List[float], Any]] = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_openai(cls, client: 'MoochForOpenAIClient', model: str = 'text-embedding-3-small', **kwargs):
+        """
+        Build a cache whose embeddings are requested through a mooch OpenAI client, switching keys too
+        
+        The embedder is called synchronously (in a worker thread on the async path), so the client must be
+        a sync `mooch(openai.OpenAI)` client even when the cache serves async wrappers.
+        """
+        if not isinstance(client, MoochForOpenAIClient):
+            raise TypeError(f"from_openai needs a sync mooch(openai.OpenAI) client, got {type(client).__name__}")
+        
+        def embedder(text):
+            response = client.switcher._execute(
+                client.api_keys,
+                lambda api_key: client._get_client(api_key).embeddings.create(model=model, input=text),
+                verbose=client.verbose,
+                labels=client._labels,
+            )
+            return response.data[0].embedding
+        return cls(embedder, **kwargs)
+
+    @staticmethod
+    def split(request: Dict[str, Any]) -> Optional[Tuple[str, str]]:
+        """
+        Split a request into (bucket, text), or None if it should not be cached
+        
+        `text` is the last user message. `bucket` hashes everything else (model, system prompt,
+        tools, max_tokens, ...), so only requests that differ in that message alone can match.
+        """
+        if not _is_deterministic(request):
+            return None
+        messages = list(request.get('messages') or [])
+        for i in range(len(messages) - 1, -1, -1):
+            message = messages[i]
+            if isinstance(message, dict) and message.get('role') == 'user' and isinstance(message.get('content'), str):
+                messages[i] = dict(message, content=None)
+                payload = json.dumps(dict(request, messages=messages), sort_keys=True, default=str)
+                return hashlib.sha256(payload.encode()).hexdigest(), message['content']
+        return None
+
+    def get(self, request: Dict[str, Any]):
+        """Return the response of the most similar cached request, or None if none is close enough"""
+        parts = self.split(request)
+        if parts is None:
+            return None
+        
+        bucket, text = parts
+        embedding = self._embed(text)
+        best_score, best_response = self.threshold, None
+        with self._lock:
+            entries = list(self._entries)
+        for entry_bucket, entry_embedding, response in entries:
+            if entry_bucket != bucket:
+                continue
+            score = _cosine(embedding, entry_embedding)
+            if score >= best_score:
+                best_score, best_response = score, response
+        return best_response
+
+    def set(self, request: Dict[str, Any], response):
+        """Cache the response under the embedding of the request's last user message"""
+        parts = self.split(request)
+        if parts is None:
+            return
+        
+        bucket, text = parts
+        entry = (bucket, self._embed(text), response)
+        with self._lock:
+            self._entries.append(entry)
+            if len(self._entries) > self.maxsize:
+                del self._entries[0]
+
+
+class LLMCache:
+    """Response cache for deterministic chat completion requests, kept in memory or in Redis"""
+
+    def __init__(
+        self,
+        maxsize: int = 1024,
+        ttl: Optional[float] = None,
+        redis=None,
+        prefix: str = 'mooch:',
+        l2: Optional[SemanticLLMCache] = None,
+    ):
+        """
+        Initialize LLMCache
+        
+        Args:
+            maxsize: Maximum number of responses kept in memory (LRU eviction)
+            ttl: Seconds before a cached response expires (None means never)
+            redis: Optional `redis.Redis` handle; when given, OpenAI/LiteLLM responses are stored there as JSON instead
+            prefix: Key prefix used in Redis
+            l2: Optional second-level cache (e.g. SemanticLLMCache) consulted on exact-match misses
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.redis = redis
+        self.prefix = prefix
+        self.l2 = l2
+        self._store: "OrderedDict[str, Tuple[Optional[float], Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(request: Dict[str, Any]) -> Optional[str]:
+        """Hash a request into a cache key, or None if its response is not deterministic"""
+        if not _is_deterministic(request):
+            return None
+        payload = json.dumps(request, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, request: Dict[str, Any]):
+        """Return the cached response for a request, or None on a miss"""
+        key = self.key(request)
+        if key is None:
+            return None
+        
+        response = self._get(key)
+        if response is None and self.l2 is not None:
+            try:
+                response = self.l2.get(request)
+            except Exception as e:
+                # A failing second level (e.g. a rate-limited embeddings endpoint) is just a miss
+                logger.warning("[Mooch] Second-level cache lookup failed: %r", e)
+                return None
+            if response is not None:
+                self._set(key, response)
+        return response
+
+    def set(self, request: Dict[str, Any], response):
+        """Cache the response for a request if it is cacheable"""
+        key = self.key(request)
+        if key is None:
+            return
+        
+        self._set(key, response)
+        if self.l2 is not None:
+            try:
+                self.l2.set(request, response)
+            except Exception as e:
+                logger.warning("[Mooch] Second-level cache store failed: %r", e)
+
+    async def aget(self, request: Dict[str, Any]):
+        """get() for event loops; Redis and second-level lookups run in a worker thread instead of blocking the loop"""
+        if self.redis is None and self.l2 is None:
+            return self.get(request)
+        return await asyncio.get_running_loop().run_in_executor(None, self.get, request)
+
+    async def aset(self, request: Dict[str, Any], response):
+        """set() for event loops; Redis and second-level stores run in a worker thread instead of blocking the loop"""
+        if self.redis is None and self.l2 is None:
+            return self.set(request, response)
+        await asyncio.get_running_loop().run_in_executor(None, self.set, request, response)
+
+    def _get(self, key: str):
+        """Look up a response by cache key"""
+        if self.redis is not None:
+            raw = self.redis.get(self.prefix + key)
+            if raw is None:
+                return None
+            try:
+                return _load_response(raw)
+            except (ValueError, TypeError, KeyError) as e:
+                logger.warning("[Mooch] Ignoring unreadable cache entry %s: %r", key, e)
+                return None
+        
+        with self._lock:
+            entry = self._store.get(key)
+            if entry is None:
+                return None
+            expires_at, response = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._store[key]
+                return None
+            self._store.move_to_end(key)
+            return response
+
+    def _set(self, key: str, response):
+        """Store a response by cache key"""
+        if self.redis is not None:
+            # JSON rather than pickle, so whoever can write to Redis cannot run code in its clients
+            raw = _dump_response(response)
+            if raw is None:
+                _debug("[Mooch] Not caching a %s response in Redis", type(response).__name__)
+                return
+            # redis-py wants whole seconds for ex
+            ex = int(math.ceil(self.ttl)) if self.ttl is not None else None
+            self.redis.set(self.prefix + key, raw, ex=ex)
+            return
+        
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._store[key] = (expires_at, response)
+            self._store.move_to_end(key)
+            while len(self._store) > self.maxsize:
+                self._store.popitem(last=False)
 
 
 class MoochSwitcher:
 
-    def __init__(self, verbose: bool = False):
+    # id(target) -> (target, handler), filled in by register()
+    _DISPATCH: ClassVar[Dict[int, Tuple[Any, Callable]]] = {}
+    
+    # Key tuples whose rotation heaps are kept; the oldest is dropped beyond this
+    _MAX_KEY_SETS: ClassVar[int] = 64
+
+    # Instance fields are declared up front so compiled builds (mypyc) store them as slots
+    default_verbose: bool
+    max_connections: int
+    keepalive_expiry: float
+    http2: bool
+    max_retries: int
+    base_delay: float
+    max_delay: float
+    jitter: float
+    cache: Optional[LLMCache]
+    race: int
+    _http: Optional[httpx.Client]
+    _ahttp: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]"
+    _rate_limit_excs: Optional[Tuple[Type[Exception], ...]]
+    _cooldowns: Dict[str, float]
+    _ready_heaps: Dict[Tuple[str, ...], List[Tuple[float, int, int]]]
+    _tiebreak: "itertools.count[int]"
+    _key_lock: threading.Lock
+    _executor: Optional[ThreadPoolExecutor]
+    _factories: Dict[Tuple[int, bool], Tuple[Callable, Callable]]
+
+    def __init__(
+        self,
+        verbose: bool = False,
+        max_connections: int = 100,
+        keepalive_expiry: float = 60,
+        http2: bool = False,
+        max_retries: int = 3,
+        base_delay: float = 1.0,
+        max_delay: float = 30,
+        jitter: float = 0.5,
+        cache: Optional[LLMCache] = None,
+        race: int = 1,
+    ):
         """
         Initialize MoochSwitcher
         
         Args:
             verbose: Default verbose setting
+            max_connections: Size of the shared HTTP connection pool
+            keepalive_expiry: Seconds an idle pooled connection is kept alive
+            http2: Whether to enable HTTP/2 (requires `httpx[http2]`)
+            max_retries: Attempts per API key before switching to the next one
+            base_delay: Initial backoff delay in seconds between attempts on the same key
+            max_delay: Upper bound in seconds for any single backoff delay
+            jitter: Maximum random fraction added on top of each backoff delay
+            cache: Optional LLMCache consulted before any API key is used
+            race: Number of keys tried in parallel per call (1 tries them one at a time)
         """
+        if max_retries < 1:
+            raise ValueError("max_retries must be at least 1 (it counts attempts per API key)")
         self.default_verbose = verbose
+        if verbose:
+            _enable_verbose_logging()
+        self.max_connections = max_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.http2 = http2
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.cache = cache
+        self.race = race
+        self._http = None
+        self._ahttp = weakref.WeakKeyDictionary()
+        self._rate_limit_excs = None
+        
+        # Rate-limit cooldowns are per key and shared by every wrapper built from this switcher;
+        # each key tuple gets a min-heap of (available_at, tiebreaker, index) entries
+        self._cooldowns = {}
+        self._ready_heaps = {}
+        self._tiebreak = itertools.count()
+        self._key_lock = threading.Lock()
+        self._executor = None
+        
+        # (target id, verbose) -> (handler, factory) built by that handler for this switcher
+        self._factories = {}
+
+    def __reduce__(self):
+        """
+        Pickle the settings only, so factories like mooch(openai.OpenAI) can be sent to other processes
+        
+        Pools, locks, key rotation state and the response cache stay behind; the copy starts fresh.
+        """
+        return (type(self), (
+            self.default_verbose, self.max_connections, self.keepalive_expiry, self.http2,
+            self.max_retries, self.base_delay, self.max_delay, self.jitter, None, self.race,
+        ))
+
+    @property
+    def http_client(self) -> httpx.Client:
+        """Shared HTTP client used by every API key, created on first use"""
+        http = self._http
+        if http is None or http.is_closed:
+            http = self._http = httpx.Client(
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                    keepalive_expiry=self.keepalive_expiry,
+                ),
+                http2=self.http2,
+                follow_redirects=True,
+            )
+        return http
 
-    def __call__(self, target, verbose: bool = None):
+    @property
+    def async_http_client(self) -> httpx.AsyncClient:
+        """
+        Async HTTP client shared by every API key on the running event loop, created on first use
+        
+        Pooled connections belong to the loop that opened them, so each loop gets its own client.
+        Outside of a running loop a new, unshared client is returned.
+        """
+        loop = _running_loop()
+        ahttp = self._ahttp.get(loop) if loop is not None else None
+        if ahttp is None or ahttp.is_closed:
+            ahttp = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                    keepalive_expiry=self.keepalive_expiry,
+                ),
+                http2=self.http2,
+                follow_redirects=True,
+            )
+            if loop is not None:
+                self._ahttp[loop] = ahttp
+        return ahttp
+
+    @property
+    def _race_executor(self) -> ThreadPoolExecutor:
+        """Worker threads for race=k, created on first use and kept for later calls"""
+        with self._key_lock:
+            if self._executor is None:
+                # Headroom for losers of earlier calls that are still in flight
+                self._executor = ThreadPoolExecutor(max_workers=self.race * 4, thread_name_prefix='mooch-race')
+            return self._executor
+
+    def close(self):
+        """Close the shared HTTP client and the race worker threads"""
+        if self._http is not None:
+            self._http.close()
+        with self._key_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    async def aclose(self):
+        """Close the shared async HTTP client of the running event loop"""
+        ahttp = self._ahttp.pop(asyncio.get_running_loop(), None)
+        if ahttp is not None:
+            await ahttp.aclose()
+
+    def __call__(self, target: Any, verbose: Optional[bool] = None) -> Callable:
         """
         Wrap OpenAI client class or LiteLLM functions
         
         Args:
-            target: The target to wrap (openai.OpenAI or litellm.completion)
-            verbose: Whether to print switching logs (overrides default)
+            target: The target to wrap (openai.OpenAI, openai.AsyncOpenAI,
+                litellm.completion or litellm.acompletion)
+            verbose: Whether to show switching logs on stdout (overrides default)
         """
         # Use provided verbose or fall back to default
         use_verbose = verbose if verbose is not None else self.default_verbose
         
-        # If target is OpenAI class, return enhanced OpenAI class
-        if target == openai.OpenAI:
-            return lambda api_keys, *args, **kwargs: MoochForOpenAIClient(api_keys, use_verbose, *args, **kwargs)
+        target_id = id(target)
+        if target_id not in self._DISPATCH:
+            _register_litellm()
+            if target_id not in self._DISPATCH:
+                raise ValueError(f"Unsupported target: {target}")
+        return self._factory(target_id, use_verbose)
+    
+    def _factory(self, target_id: int, use_verbose: bool):
+        """Build (once per switcher, target and verbosity) the factory that takes api_keys"""
+        handler = self._DISPATCH[target_id][1]
+        cached = self._factories.get((target_id, use_verbose))
+        # A target registered again gets a new handler, which invalidates the old factory
+        if cached is None or cached[0] is not handler:
+            cached = self._factories[target_id, use_verbose] = (handler, handler(self, use_verbose))
+        return cached[1]
+    
+    @classmethod
+    def register(cls, target, handler: Callable):
+        """
+        Register a wrapper for a new target
         
-        # If target is LiteLLM completion function, return enhanced LiteLLM class
-        elif target == litellm.completion:
-            return lambda api_keys: MoochForLiteLLMCompletion(api_keys, use_verbose)
+        Args:
+            target: The client class or function users will pass to mooch(...)
+            handler: Called as handler(switcher, verbose); returns the factory that takes api_keys
+        """
+        # The target is kept alongside the handler so its id() cannot be reused
+        cls._DISPATCH[id(target)] = (target, handler)
+    
+    def _backoff_delay(self, attempt: int, error: Exception) -> float:
+        """Exponential backoff with jitter, deferring to the server's Retry-After when given"""
+        delay = _retry_after(error)
+        if delay is None:
+            delay = self.base_delay * 2 ** attempt * (1 + random.uniform(0, self.jitter))
+        return min(self.max_delay, delay)
+    
+    @property
+    def rate_limit_errors(self) -> Tuple[Type[Exception], ...]:
+        """Exception types treated as rate limits; litellm's are included once litellm is imported"""
+        litellm: Any = sys.modules.get('litellm')
+        excs = self._rate_limit_excs
+        if excs is None or (litellm is not None and litellm.RateLimitError not in excs):
+            candidates: List[Optional[Type[Exception]]] = [openai.RateLimitError, httpx.HTTPStatusError]
+            if litellm is not None:
+                candidates += [getattr(litellm, 'RateLimitError', None), getattr(litellm.exceptions, 'RateLimitError', None)]
+            excs = self._rate_limit_excs = tuple(OrderedDict.fromkeys(exc for exc in candidates if exc is not None))
+        return excs
+    
+    def _next_key(self, api_keys: Tuple[str, ...], tried: set) -> Tuple[int, float]:
+        """
+        Pick the best untried key in O(log N): earliest available, then least recently used
         
-        else:
-            raise ValueError(f"Unsupported target: {target}")
+        Returns the key's index and how many seconds it is still cooling down (0 if ready).
+        Heap ops never await, so the threading lock is also safe to use from asyncio.
+        """
+        with self._key_lock:
+            heap = self._ready_heaps.get(api_keys)
+            if heap is None:
+                if len(self._ready_heaps) >= self._MAX_KEY_SETS:
+                    del self._ready_heaps[next(iter(self._ready_heaps))]
+                heap = [(0.0, next(self._tiebreak), i) for i in range(len(api_keys))]
+                self._ready_heaps[api_keys] = heap
+            
+            skipped = []
+            while True:
+                entry = heapq.heappop(heap)
+                available_at, _, i = entry
+                cooldown_until = self._cooldowns.get(api_keys[i], 0.0)
+                if available_at < cooldown_until:
+                    # Rate limited since this entry was pushed; re-queue it at its cooldown
+                    heapq.heappush(heap, (cooldown_until, next(self._tiebreak), i))
+                elif i in tried:
+                    skipped.append(entry)
+                else:
+                    break
+            for entry in skipped:
+                heapq.heappush(heap, entry)
+            
+            # Rotate the chosen key to the back of the ready keys
+            now = time.monotonic()
+            heapq.heappush(heap, (max(available_at, now), next(self._tiebreak), i))
+        return i, max(0.0, available_at - now)
+    
+    def _cool_down(self, api_key: str, attempt: int, error: Exception):
+        """Deprioritise a rate-limited API key until its Retry-After (or backoff delay) has passed"""
+        cooldown = _retry_after(error)
+        if cooldown is None:
+            cooldown = self._backoff_delay(attempt, error)
+        with self._key_lock:
+            self._cooldowns[api_key] = time.monotonic() + cooldown
+    
+    def _exhausted(
+        self,
+        api_keys: Tuple[str, ...],
+        errors: Dict[str, Exception],
+        last_error: Optional[Exception],
+    ) -> AllKeysExhaustedError:
+        """The error raised once every key has been rate limited"""
+        with self._key_lock:
+            cooldown_until = min(self._cooldowns.get(api_key, 0.0) for api_key in api_keys)
+        next_retry = max(0.0, cooldown_until - time.monotonic())
+        error = AllKeysExhaustedError(errors, next_retry, len(api_keys))
+        # Set explicitly rather than with `raise ... from`, which a mypyc build drops
+        error.__cause__ = last_error
+        return error
+    
+    def _cache_get(self, request: Optional[Dict[str, Any]]) -> Any:
+        """Cached response for a request, or None on a miss or when caching does not apply"""
+        if request is None or self.cache is None:
+            return None
+        return self.cache.get(request)
+    
+    def _cache_set(self, request: Optional[Dict[str, Any]], response: Any):
+        """Store a response if caching applies to its request"""
+        if request is not None and self.cache is not None:
+            self.cache.set(request, response)
+    
+    async def _acache_get(self, request: Optional[Dict[str, Any]]) -> Any:
+        """Async counterpart of _cache_get"""
+        if request is None or self.cache is None:
+            return None
+        return await self.cache.aget(request)
     
-    def _execute(self, api_keys: Union[str, List[str]], call_func: Callable, verbose: bool = False):
+    async def _acache_set(self, request: Optional[Dict[str, Any]], response: Any):
+        """Async counterpart of _cache_set"""
+        if request is not None and self.cache is not None:
+            await self.cache.aset(request, response)
+    
+    def _cache_request(
+        self,
+        args: tuple,
+        kwargs: Dict[str, Any],
+        scope: Optional[Tuple[str, Optional[str]]] = None,
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Pop the `_no_cache` escape hatch from kwargs and return the request to cache, if any
+        
+        `scope` (the wrapper's target and base_url) is part of the request, so wrappers sharing
+        the switcher's cache never serve each other's responses.
+        """
+        if kwargs.pop('_no_cache', False) or self.cache is None:
+            return None
+        request = dict(kwargs)
+        if scope is not None:
+            request['_scope'] = list(scope)
+        if args:
+            request['args'] = list(args)
+        return request
+    
+    def _execute(
+        self,
+        api_keys: Tuple[str, ...],
+        call_func: Callable,
+        verbose: bool = False,
+        request: Optional[Dict[str, Any]] = None,
+        labels: Optional[_KeyLabels] = None,
+    ):
         """Common switching logic for both OpenAI and LiteLLM"""
-        if isinstance(api_keys, str):
-            api_keys = [api_keys]
+        token = _verbose_var.set(verbose)
+        try:
+            n_keys = len(api_keys)
+            if labels is None:
+                labels = _key_labels(api_keys)
 
-        last_error = None
-        
-        for i, api_key in enumerate(api_keys):
-            try:
-                if verbose:
-                    print()
-                    print(f"[Mooch] Trying API key {i+1}/{len(api_keys)}: {api_key[:10]}...")
+            cached = self._cache_get(request)
+            if cached is not None:
+                _debug("[Mooch] ✓ Cache hit")
+                return cached
+
+            if self.race > 1 and n_keys > 1:
+                result = self._execute_race(api_keys, call_func, labels)
+                self._cache_set(request, result)
+                return result
+
+            rate_limit_errors = self.rate_limit_errors
+            last_error: Optional[Exception] = None
+            errors: Dict[str, Exception] = {}
+            
+            tried: Set[int] = set()
+            waited = False
+            while len(tried) < n_keys:
+                i, wait = self._next_key(api_keys, tried)
+                if wait > 0:
+                    # Wait for a cooling key at most once per call; past that the caller decides when to retry
+                    if waited or wait > self.max_delay:
+                        _debug("[Mooch] All remaining API keys are cooling down for %.1fs", wait)
+                        break
+                    _debug("[Mooch] All remaining API keys are cooling down, waiting %.1fs...", wait)
+                    time.sleep(wait)
+                    waited = True
+                tried.add(i)
+                api_key = api_keys[i]
+                _debug(labels.trying[i])
                 
-                result = call_func(api_key)
+                for attempt in range(self.max_retries):
+                    try:
+                        result = call_func(api_key)
+                        
+                        _debug(labels.success[i])
+                        
+                        self._cache_set(request, result)
+                        return result
+                        
+                    except rate_limit_errors as e:
+                        # Providers surfacing raw HTTP errors only count as rate limited on a 429
+                        if isinstance(e, httpx.HTTPStatusError) and e.response.status_code != 429:
+                            raise
+                        last_error = errors[api_key] = e
+                        if attempt + 1 >= self.max_retries:
+                            self._cool_down(api_key, attempt, e)
+                            break
+                        delay = self._backoff_delay(attempt, e)
+                        _debug("%s, retrying in %.1fs...", labels.rate_limited[i], delay)
+                        time.sleep(delay)
                 
-                if verbose:
-                    print(f"[Mooch] ✓ Success with API key {i+1}")
+                _debug("%s, switching...", labels.rate_limited[i])
+            
+            # All API keys failed
+            _debug("[Mooch] ✗ All %d API keys failed", n_keys)
+            raise self._exhausted(api_keys, errors, last_error)
+        finally:
+            _verbose_var.reset(token)
+    
+    def _execute_race(self, api_keys: Tuple[str, ...], call_func: Callable, labels: _KeyLabels):
+        """
+        Try the best `race` keys in parallel and return the first success
+        
+        Each key is tried once (no same-key backoff). Cooling keys are skipped, waiting for one at most
+        once per call as in _execute. Losers that have not started are cancelled; requests already in
+        flight run to completion in the background.
+        """
+        n_keys = len(api_keys)
+        rate_limit_errors = self.rate_limit_errors
+        last_error: Optional[Exception] = None
+        errors: Dict[str, Exception] = {}
+        executor = self._race_executor
+        
+        tried: Set[int] = set()
+        waited = False
+        while len(tried) < n_keys:
+            futures: Dict[Any, int] = {}
+            for _ in range(min(self.race, n_keys - len(tried))):
+                i, wait = self._next_key(api_keys, tried)
+                if wait > 0:
+                    # The remaining keys are all cooling down; race the ready ones or wait for one at most once
+                    if futures or waited or wait > self.max_delay:
+                        break
+                    _debug("[Mooch] All remaining API keys are cooling down, waiting %.1fs...", wait)
+                    time.sleep(wait)
+                    waited = True
+                tried.add(i)
+                future = executor.submit(contextvars.copy_context().run, call_func, api_keys[i])
+                futures[future] = i
+            if not futures:
+                _debug("[Mooch] All remaining API keys are cooling down")
+                break
+            _debug("[Mooch] Racing API keys %s", ", ".join(str(i + 1) for i in futures.values()))
+            
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    result = future.result()
+                except rate_limit_errors as e:
+                    if isinstance(e, httpx.HTTPStatusError) and e.response.status_code != 429:
+                        raise
+                    last_error = errors[api_keys[i]] = e
+                    self._cool_down(api_keys[i], 0, e)
+                    _debug(labels.rate_limited[i])
+                    continue
                 
+                _debug(labels.success[i])
+                for other in futures:
+                    other.cancel()
                 return result
+        
+        _debug("[Mooch] ✗ All %d API keys failed", n_keys)
+        raise self._exhausted(api_keys, errors, last_error)
+    
+    async def _aexecute(
+        self,
+        api_keys: Tuple[str, ...],
+        call_func: Callable,
+        verbose: bool = False,
+        request: Optional[Dict[str, Any]] = None,
+        labels: Optional[_KeyLabels] = None,
+    ):
+        """Async counterpart of _execute; call_func returns an awaitable"""
+        token = _verbose_var.set(verbose)
+        try:
+            n_keys = len(api_keys)
+            if labels is None:
+                labels = _key_labels(api_keys)
+
+            cached = await self._acache_get(request)
+            if cached is not None:
+                _debug("[Mooch] ✓ Cache hit")
+                return cached
+
+            if self.race > 1 and n_keys > 1:
+                result = await self._aexecute_race(api_keys, call_func, labels)
+                await self._acache_set(request, result)
+                return result
+
+            rate_limit_errors = self.rate_limit_errors
+            last_error: Optional[Exception] = None
+            errors: Dict[str, Exception] = {}
+            
+            tried: Set[int] = set()
+            waited = False
+            while len(tried) < n_keys:
+                i, wait = self._next_key(api_keys, tried)
+                if wait > 0:
+                    # Wait for a cooling key at most once per call; past that the caller decides when to retry
+                    if waited or wait > self.max_delay:
+                        _debug("[Mooch] All remaining API keys are cooling down for %.1fs", wait)
+                        break
+                    _debug("[Mooch] All remaining API keys are cooling down, waiting %.1fs...", wait)
+                    await asyncio.sleep(wait)
+                    waited = True
+                tried.add(i)
+                api_key = api_keys[i]
+                _debug(labels.trying[i])
                 
-            except openai.RateLimitError as e:
-                if verbose:
-                    print(f"[Mooch] ✗ Rate limit hit with API key {i+1}, switching...")
-                last_error = e
-                continue
+                for attempt in range(self.max_retries):
+                    try:
+                        result = await call_func(api_key)
+                        
+                        _debug(labels.success[i])
+                        
+                        await self._acache_set(request, result)
+                        return result
+                        
+                    except rate_limit_errors as e:
+                        # Providers surfacing raw HTTP errors only count as rate limited on a 429
+                        if isinstance(e, httpx.HTTPStatusError) and e.response.status_code != 429:
+                            raise
+                        last_error = errors[api_key] = e
+                        if attempt + 1 >= self.max_retries:
+                            self._cool_down(api_key, attempt, e)
+                            break
+                        delay = self._backoff_delay(attempt, e)
+                        _debug("%s, retrying in %.1fs...", labels.rate_limited[i], delay)
+                        await asyncio.sleep(delay)
+                
+                _debug("%s, switching...", labels.rate_limited[i])
+            
+            # All API keys failed
+            _debug("[Mooch] ✗ All %d API keys failed", n_keys)
+            raise self._exhausted(api_keys, errors, last_error)
+        finally:
+            _verbose_var.reset(token)
+
+    
+    async def _aexecute_race(self, api_keys: Tuple[str, ...], call_func: Callable, labels: _KeyLabels):
+        """Async counterpart of _execute_race; losing requests are cancelled"""
+        n_keys = len(api_keys)
+        rate_limit_errors = self.rate_limit_errors
+        last_error: Optional[Exception] = None
+        errors: Dict[str, Exception] = {}
         
-        # All API keys failed
-        if verbose:
-            print(f"[Mooch] ✗ All {len(api_keys)} API keys failed")
-        raise last_error
+        tried: Set[int] = set()
+        waited = False
+        while len(tried) < n_keys:
+            tasks: Dict[Any, int] = {}
+            for _ in range(min(self.race, n_keys - len(tried))):
+                i, wait = self._next_key(api_keys, tried)
+                if wait > 0:
+                    if tasks or waited or wait > self.max_delay:
+                        break
+                    _debug("[Mooch] All remaining API keys are cooling down, waiting %.1fs...", wait)
+                    await asyncio.sleep(wait)
+                    waited = True
+                tried.add(i)
+                tasks[asyncio.ensure_future(call_func(api_keys[i]))] = i
+            if not tasks:
+                _debug("[Mooch] All remaining API keys are cooling down")
+                break
+            _debug("[Mooch] Racing API keys %s", ", ".join(str(i + 1) for i in tasks.values()))
+            
+            pending = set(tasks)
+            try:
+                while pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        i = tasks[task]
+                        try:
+                            result = task.result()
+                        except rate_limit_errors as e:
+                            if isinstance(e, httpx.HTTPStatusError) and e.response.status_code != 429:
+                                raise
+                            last_error = errors[api_keys[i]] = e
+                            self._cool_down(api_keys[i], 0, e)
+                            _debug(labels.rate_limited[i])
+                            continue
+                        
+                        _debug(labels.success[i])
+                        return result
+            finally:
+                for task in pending:
+                    task.cancel()
+        
+        _debug("[Mooch] ✗ All %d API keys failed", n_keys)
+        raise self._exhausted(api_keys, errors, last_error)
 
 
-class MoochForOpenAIClient(openai.OpenAI):
+class MoochForOpenAIClient:
     """Enhanced OpenAI client that switches API keys on rate limit errors"""
     
-    def __init__(self, api_keys: List[str], verbose: bool = False, *args, **kwargs):
-        self.api_keys = api_keys
+    def __init__(
+        self,
+        api_keys: Union[str, List[str]],
+        verbose: bool = False,
+        *args,
+        switcher: Optional[MoochSwitcher] = None,
+        prewarm: bool = True,
+        **kwargs,
+    ):
+        self.api_keys = (api_keys,) if isinstance(api_keys, str) else tuple(api_keys)
+        self._labels = _key_labels(self.api_keys)
+        # Cache entries are scoped to the target and endpoint this wrapper talks to
+        self._cache_scope = ('openai.OpenAI', str(kwargs['base_url']) if kwargs.get('base_url') else None)
         self.verbose = verbose
-        self.switcher = MoochSwitcher(verbose)
-        self.init_args = args
+        self.switcher = switcher if switcher is not None else MoochSwitcher(verbose)
+        if verbose:
+            _enable_verbose_logging()
         self.init_kwargs = kwargs
         
-        # Initialize with first API key
-        super().__init__(api_key=api_keys[0], *args, **kwargs)
+        # Retrying and rotating on 429s is mooch's job; the SDK's own retries would hide them from it
+        self.init_kwargs.setdefault('max_retries', 0)
+        
+        # All per-key clients share the switcher's connection pool unless the caller brings their own
+        self._http_client: Optional[httpx.Client] = kwargs.pop('http_client', None)
+        
+        if not self.api_keys:
+            raise IndexError("api_keys must not be empty")
         
-        # Override the chat.completions.create method
-        self.chat.completions.create = self._create
+        # Client args are bound once; per-key clients are built lazily per pool and reused for every later call
+        self._client_factory = functools.partial(openai.OpenAI, *args, **self.init_kwargs)
+        self._pool_clients: Callable[[str, httpx.Client], Any] = functools.lru_cache(maxsize=len(self.api_keys))(
+            lambda api_key, http_client: self._client_factory(api_key=api_key, http_client=http_client)
+        )
+        
+        # Only chat.completions.create switches keys; other attributes fall through to the first key's client
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+        
+        if prewarm:
+            threading.Thread(target=self._prewarm, daemon=True).start()
+    
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._get_client(self.api_keys[0]), name)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    @property
+    def _pool(self) -> httpx.Client:
+        """The caller's http_client, else the switcher's shared pool (looked up each time, so a closed one is replaced)"""
+        return self._http_client if self._http_client is not None else self.switcher.http_client
+    
+    def _prewarm(self):
+        """Open a keep-alive connection to base_url so the first request skips the TLS handshake"""
+        try:
+            self._pool.head(str(self.base_url), timeout=2.0)
+        except Exception as e:
+            # Best effort only: runs on a daemon thread, where any error would just print a traceback
+            _debug("[Mooch] Pre-warming %s failed: %r", self.init_kwargs.get('base_url'), e)
     
     def _create(self, *args, **kwargs):
         """Create chat completion with API key switching"""
+        request = self.switcher._cache_request(args, kwargs, self._cache_scope)
         return self.switcher._execute(
             self.api_keys,
             lambda api_key: self._call(api_key, *args, **kwargs),
-            verbose=self.verbose
+            verbose=self.verbose,
+            request=request,
+            labels=self._labels,
         )
     
     def _call(self, api_key, *args, **kwargs):
         """Call OpenAI with specific API key"""
-        temp_client = openai.OpenAI(api_key=api_key, *self.init_args, **self.init_kwargs)
-        return temp_client.chat.completions.create(*args, **kwargs)
+        return self._get_client(api_key).chat.completions.create(*args, **kwargs)
+    
+    def _get_client(self, api_key: str):
+        """Get (or lazily create) the OpenAI client for an API key on the current pool"""
+        return self._pool_clients(api_key, self._pool)
+    
+    def close(self):
+        """Release per-key clients; a shared pool is left to its owning switcher"""
+        self._pool_clients.cache_clear()
+        if self._http_client is not None:
+            self._http_client.close()
 
 
 class MoochForLiteLLMCompletion:
     """Enhanced LiteLLM completion that switches API keys on rate limit errors"""
     
-    def __init__(self, api_keys: List[str], verbose: bool = False):
-        self.api_keys = api_keys
+    def __init__(self, api_keys: Union[str, List[str]], verbose: bool = False, switcher: Optional[MoochSwitcher] = None):
+        self.api_keys = (api_keys,) if isinstance(api_keys, str) else tuple(api_keys)
+        self._labels = _key_labels(self.api_keys)
+        self._cache_scope: Tuple[str, Optional[str]] = ('litellm.completion', None)
         self.verbose = verbose
-        self.switcher = MoochSwitcher(verbose)
+        self.switcher = switcher if switcher is not None else MoochSwitcher(verbose)
+        if verbose:
+            _enable_verbose_logging()
     
     def __call__(self, *args, **kwargs):
         """Call LiteLLM completion with API key switching"""
+        request = self.switcher._cache_request(args, kwargs, self._cache_scope)
         return self.switcher._execute(
             self.api_keys,
             lambda api_key: self._call(api_key, *args, **kwargs),
-            verbose=self.verbose
+            verbose=self.verbose,
+            request=request,
+            labels=self._labels,
         )
     
     def _call(self, api_key, *args, **kwargs):
         """Call LiteLLM function with specific API key"""
+        import litellm
         kwargs['api_key'] = api_key
         return litellm.completion(*args, **kwargs)
 
 
+class MoochForAsyncOpenAIClient:
+    """Enhanced AsyncOpenAI client that switches API keys on rate limit errors"""
+    
+    def __init__(
+        self,
+        api_keys: Union[str, List[str]],
+        verbose: bool = False,
+        *args,
+        switcher: Optional[MoochSwitcher] = None,
+        **kwargs,
+    ):
+        self.api_keys = (api_keys,) if isinstance(api_keys, str) else tuple(api_keys)
+        self._labels = _key_labels(self.api_keys)
+        # Cache entries are scoped to the target and endpoint this wrapper talks to
+        self._cache_scope = ('openai.AsyncOpenAI', str(kwargs['base_url']) if kwargs.get('base_url') else None)
+        self.verbose = verbose
+        self.switcher = switcher if switcher is not None else MoochSwitcher(verbose)
+        if verbose:
+            _enable_verbose_logging()
+        self.init_kwargs = kwargs
+        
+        # Retrying and rotating on 429s is mooch's job; the SDK's own retries would hide them from it
+        self.init_kwargs.setdefault('max_retries', 0)
+        
+        # Per-key clients share the switcher's pool for the running loop unless the caller brings their own
+        self._http_client: Optional[httpx.AsyncClient] = kwargs.pop('http_client', None)
+        
+        if not self.api_keys:
+            raise IndexError("api_keys must not be empty")
+        
+        # Client args are bound once; per-key clients are built lazily per pool (so per event loop) and reused
+        self._client_factory = functools.partial(openai.AsyncOpenAI, *args, **self.init_kwargs)
+        self._pool_clients: Callable[[str, httpx.AsyncClient], Any] = functools.lru_cache(maxsize=len(self.api_keys))(
+            lambda api_key, http_client: self._client_factory(api_key=api_key, http_client=http_client)
+        )
+        
+        # Only chat.completions.create switches keys; other attributes fall through to the first key's client
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+    
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._get_client(self.api_keys[0]), name)
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, *exc_info):
+        await self.close()
+    
+    async def _create(self, *args, **kwargs):
+        """Create chat completion with API key switching"""
+        request = self.switcher._cache_request(args, kwargs, self._cache_scope)
+        return await self.switcher._aexecute(
+            self.api_keys,
+            lambda api_key: self._call(api_key, *args, **kwargs),
+            verbose=self.verbose,
+            request=request,
+            labels=self._labels,
+        )
+    
+    async def _call(self, api_key, *args, **kwargs):
+        """Call AsyncOpenAI with specific API key"""
+        return await self._get_client(api_key).chat.completions.create(*args, **kwargs)
+    
+    def _get_client(self, api_key: str):
+        """Get (or lazily create) the AsyncOpenAI client for an API key on the running event loop's pool"""
+        pool = self._http_client if self._http_client is not None else self.switcher.async_http_client
+        return self._pool_clients(api_key, pool)
+    
+    async def close(self):
+        """Release per-key clients; a shared pool is left to its owning switcher"""
+        self._pool_clients.cache_clear()
+        if self._http_client is not None:
+            await self._http_client.aclose()
+
+
+class MoochForLiteLLMAcompletion:
+    """Enhanced LiteLLM acompletion that switches API keys on rate limit errors"""
+    
+    def __init__(self, api_keys: Union[str, List[str]], verbose: bool = False, switcher: Optional[MoochSwitcher] = None):
+        self.api_keys = (api_keys,) if isinstance(api_keys, str) else tuple(api_keys)
+        self._labels = _key_labels(self.api_keys)
+        self._cache_scope: Tuple[str, Optional[str]] = ('litellm.acompletion', None)
+        self.verbose = verbose
+        self.switcher = switcher if switcher is not None else MoochSwitcher(verbose)
+        if verbose:
+            _enable_verbose_logging()
+    
+    async def __call__(self, *args, **kwargs):
+        """Call LiteLLM acompletion with API key switching"""
+        request = self.switcher._cache_request(args, kwargs, self._cache_scope)
+        return await self.switcher._aexecute(
+            self.api_keys,
+            lambda api_key: self._call(api_key, *args, **kwargs),
+            verbose=self.verbose,
+            request=request,
+            labels=self._labels,
+        )
+    
+    async def _call(self, api_key, *args, **kwargs):
+        """Call LiteLLM async function with specific API key"""
+        import litellm
+        kwargs['api_key'] = api_key
+        return await litellm.acompletion(*args, **kwargs)
+
+
+def _wrap_openai_sync(switcher: MoochSwitcher, verbose: bool):
+    """Factory building a MoochForOpenAIClient"""
+    return functools.partial(MoochForOpenAIClient, verbose=verbose, switcher=switcher)
+
+
+def _wrap_openai_async(switcher: MoochSwitcher, verbose: bool):
+    """Factory building a MoochForAsyncOpenAIClient"""
+    return functools.partial(MoochForAsyncOpenAIClient, verbose=verbose, switcher=switcher)
+
+
+def _wrap_litellm_sync(switcher: MoochSwitcher, verbose: bool):
+    """Factory building a MoochForLiteLLMCompletion"""
+    return functools.partial(MoochForLiteLLMCompletion, verbose=verbose, switcher=switcher)
+
+
+def _wrap_litellm_async(switcher: MoochSwitcher, verbose: bool):
+    """Factory building a MoochForLiteLLMAcompletion"""
+    return functools.partial(MoochForLiteLLMAcompletion, verbose=verbose, switcher=switcher)
+
+
+def _register_litellm():
+    """Register the LiteLLM wrappers, but only once the caller has imported litellm themselves"""
+    litellm = sys.modules.get('litellm')
+    if litellm is None or id(litellm.completion) in MoochSwitcher._DISPATCH:
+        return
+    MoochSwitcher.register(litellm.completion, _wrap_litellm_sync)
+    MoochSwitcher.register(litellm.acompletion, _wrap_litellm_async)
+
+
+MoochSwitcher.register(openai.OpenAI, _wrap_openai_sync)
+MoochSwitcher.register(openai.AsyncOpenAI, _wrap_openai_async)
+
 # Global mooch switcher instance
 mooch = MoochSwitcher()
 
 
 if __name__ == "__main__":
     import os
+    import litellm
     
     if not os.path.exists('configs/config.yaml'):
         print("config.yaml does not exist")
@@ -1,8 +1,17 @@
+import json
+import time
+import pickle
+import asyncio
+import logging
 import unittest
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import yaml
+import httpx
 import openai
 import litellm
-from mooch import mooch
+from openai.types.chat import ChatCompletion
+from mooch import mooch, MoochSwitcher, LLMCache, SemanticLLMCache, AllKeysExhaustedError
 
 
 class TestMoochSwitch(unittest.TestCase):
@@ -33,14 +42,13 @@ class TestMoochSwitch(unittest.TestCase):
             base_url=self.config['openai']['base_url']
         )
         
-        # Verify it's the right type and has expected attributes
-        self.assertIsInstance(client, openai.OpenAI)
+        # Verify it exposes the OpenAI client interface
         self.assertTrue(hasattr(client, 'chat'))
         self.assertTrue(hasattr(client.chat, 'completions'))
         self.assertTrue(hasattr(client.chat.completions, 'create'))
         
         # Verify API keys are stored
-        self.assertEqual(client.api_keys, api_keys)
+        self.assertEqual(client.api_keys, tuple(api_keys))
     
     def test_litellm_wrapper_creation(self):
         """Test LiteLLM completion wrapper creation"""
@@ -52,7 +60,7 @@ class TestMoochSwitch(unittest.TestCase):
         
         # Verify it's callable and has expected attributes
         self.assertTrue(callable(completion))
-        self.assertEqual(completion.api_keys, api_keys)
+        self.assertEqual(completion.api_keys, tuple(api_keys))
     
     def test_openai_completion(self):
         """Test actual OpenAI completion call"""
@@ -126,5 +134,467 @@ class TestMoochSwitch(unittest.TestCase):
             mooch(openai.OpenAI)(api_keys=[])
 
 
+
+class TestMoochSwitchLogic(unittest.TestCase):
+    """Offline tests for the switching logic, using fake calls instead of real API keys"""
+    
+    def rate_limit_error(self, headers=None):
+        """Build an openai.RateLimitError carrying the given response headers"""
+        response = httpx.Response(429, headers=headers or {}, request=httpx.Request('POST', 'http://test'))
+        return openai.RateLimitError('rate limited', response=response, body=None)
+    
+    def serve(self, status=200, headers=None):
+        """Start a local keep-alive server answering POSTs with a chat completion; returns (base_url, methods seen)"""
+        methods = []
+        
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            
+            def do_HEAD(self):
+                methods.append('HEAD')
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+            
+            def do_POST(self):
+                methods.append('POST')
+                self.rfile.read(int(self.headers['Content-Length']))
+                body = json.dumps({
+                    'id': 'test', 'object': 'chat.completion', 'created': 0, 'model': 'test',
+                    'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': 'ok'}}],
+                }).encode()
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            
+            def log_message(self, *args):
+                pass
+        
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return f'http://127.0.0.1:{server.server_port}/v1', methods
+    
+    def test_openai_sdk_retries_are_left_to_mooch(self):
+        """Test that a 429 reaches mooch's own backoff and rotation instead of the SDK's retries"""
+        base_url, methods = self.serve(429, {'Retry-After': '0'})
+        switcher = MoochSwitcher(max_retries=2, base_delay=0.01)
+        client = switcher(openai.OpenAI)(api_keys=['key1', 'key2'], base_url=base_url, prewarm=False)
+        
+        start = time.monotonic()
+        with self.assertRaises(AllKeysExhaustedError):
+            client.chat.completions.create(model='test', messages=[{'role': 'user', 'content': 'hi'}])
+        self.assertEqual(methods, ['POST'] * 4)
+        self.assertLess(time.monotonic() - start, 2)
+    
+    def test_retries_same_key_before_switching(self):
+        """Test that a key is retried with backoff before moving to the next one"""
+        switcher = MoochSwitcher(max_retries=3, base_delay=0.001)
+        calls = []
+        
+        def call_func(api_key):
+            calls.append(api_key)
+            if api_key == 'key1':
+                raise self.rate_limit_error({'Retry-After': '0.001'})
+            return 'ok'
+        
+        self.assertEqual(switcher._execute(('key1', 'key2'), call_func), 'ok')
+        self.assertEqual(calls, ['key1', 'key1', 'key1', 'key2'])
+    
+    def test_switching_is_logged_per_key(self):
+        """Test the precomputed per-key log messages"""
+        switcher = MoochSwitcher(max_retries=1)
+        
+        def call_func(api_key):
+            if api_key == 'sk-first-key':
+                raise self.rate_limit_error()
+            return 'ok'
+        
+        with self.assertLogs('mooch', level='DEBUG') as logs:
+            switcher._execute(('sk-first-key', 'sk-second-key'), call_func)
+        self.assertEqual([record.getMessage() for record in logs.records], [
+            "[Mooch] Trying API key 1/2: sk-first-k...",
+            "[Mooch] ✗ Rate limit hit with API key 1, switching...",
+            "[Mooch] Trying API key 2/2: sk-second-...",
+            "[Mooch] ✓ Success with API key 2",
+        ])
+    
+    def test_verbose_wrappers_do_not_make_quiet_ones_log(self):
+        """Test that verbose logs only reach stdout and quiet calls stay quiet once a verbose wrapper exists"""
+        class ListHandler(logging.Handler):
+            def __init__(self):
+                super().__init__()
+                self.messages = []
+            
+            def emit(self, record):
+                self.messages.append(record.getMessage())
+        
+        root, verbose_logger = logging.getLogger(), logging.getLogger('mooch.verbose')
+        root_handler, verbose_handler = ListHandler(), ListHandler()
+        root.addHandler(root_handler)
+        self.addCleanup(root.removeHandler, root_handler)
+        
+        switcher = MoochSwitcher()
+        switcher(openai.OpenAI, verbose=True)(api_keys=['key1'], prewarm=False)
+        verbose_logger.addHandler(verbose_handler)
+        self.addCleanup(verbose_logger.removeHandler, verbose_handler)
+        
+        switcher._execute(('key1',), lambda api_key: 'ok')
+        self.assertEqual((root_handler.messages, verbose_handler.messages), ([], []))
+        
+        switcher._execute(('key1',), lambda api_key: 'ok', verbose=True)
+        self.assertEqual(root_handler.messages, [])
+        self.assertEqual(verbose_handler.messages, ["[Mooch] Trying API key 1/1: key1...", "[Mooch] ✓ Success with API key 1"])
+    
+    def test_max_retries_must_allow_an_attempt(self):
+        """Test that max_retries below 1 is rejected instead of never calling any key"""
+        with self.assertRaises(ValueError):
+            MoochSwitcher(max_retries=0)
+    
+    def test_http_429_is_treated_as_rate_limit(self):
+        """Test that a raw httpx 429 switches keys while other HTTP errors propagate"""
+        switcher = MoochSwitcher(max_retries=1)
+        
+        def http_error(status_code):
+            request = httpx.Request('POST', 'http://test')
+            response = httpx.Response(status_code, headers={'retry-after-ms': '5'}, request=request)
+            return httpx.HTTPStatusError('error', request=request, response=response)
+        
+        def call_func(api_key):
+            if api_key == 'key1':
+                raise http_error(429)
+            raise http_error(500)
+        
+        with self.assertRaises(httpx.HTTPStatusError) as context:
+            switcher._execute(('key1', 'key2'), call_func)
+        self.assertEqual(context.exception.response.status_code, 500)
+    
+    def test_all_keys_exhausted(self):
+        """Test that exhausting every key reports each key's error and the shortest Retry-After"""
+        switcher = MoochSwitcher(max_retries=1)
+        errors = {'key1': self.rate_limit_error({'Retry-After': '7'}), 'key2': self.rate_limit_error({'Retry-After': '3'})}
+        
+        def call_func(api_key):
+            raise errors[api_key]
+        
+        with self.assertRaises(AllKeysExhaustedError) as context:
+            switcher._execute(('key1', 'key2'), call_func)
+        self.assertEqual(context.exception.per_key, errors)
+        self.assertAlmostEqual(context.exception.next_retry, 3.0, delta=0.5)
+        self.assertLessEqual(context.exception.next_retry, 3.0)
+        self.assertIn(context.exception.__cause__, errors.values())
+        
+        switcher = MoochSwitcher(max_retries=1, race=2)
+        with self.assertRaises(AllKeysExhaustedError) as context:
+            switcher._execute(('key1', 'key2'), call_func)
+        self.assertEqual(context.exception.per_key, errors)
+        
+        with self.assertRaisesRegex(AllKeysExhaustedError, "All 3 API keys"):
+            MoochSwitcher(max_retries=1, max_delay=0.1)._execute(('key1', 'key1', 'key2'), call_func)
+    
+    def test_spreads_load_and_skips_cooling_keys(self):
+        """Test that calls start from the least recently used key and avoid rate-limited ones"""
+        switcher = MoochSwitcher(max_retries=1)
+        used = []
+        
+        def call_func(api_key):
+            used.append(api_key)
+            if api_key == 'key2':
+                raise self.rate_limit_error({'Retry-After': '60'})
+            return api_key
+        
+        keys = ('key1', 'key2', 'key3')
+        results = [switcher._execute(keys, call_func) for _ in range(4)]
+        self.assertEqual(results, ['key1', 'key3', 'key1', 'key3'])
+        self.assertEqual(used, ['key1', 'key2', 'key3', 'key1', 'key3'])
+    
+    def test_cooling_keys_fail_fast(self):
+        """Test that keys cooling down longer than max_delay are not waited on"""
+        switcher = MoochSwitcher(max_retries=1, max_delay=0.5)
+        calls = []
+        
+        def call_func(api_key):
+            calls.append(api_key)
+            raise self.rate_limit_error({'Retry-After': '3600'})
+        
+        keys = ('key1', 'key2', 'key3', 'key4')
+        with self.assertRaises(AllKeysExhaustedError):
+            switcher._execute(keys, call_func)
+        
+        start = time.monotonic()
+        with self.assertRaises(AllKeysExhaustedError):
+            switcher._execute(keys, call_func)
+        self.assertLess(time.monotonic() - start, 0.1)
+        self.assertEqual(len(calls), 4)
+    
+    def test_key_set_heaps_are_bounded(self):
+        """Test that rotation state is not kept for an unbounded number of key tuples"""
+        switcher = MoochSwitcher()
+        for n in range(MoochSwitcher._MAX_KEY_SETS + 10):
+            switcher._execute((f'key{n}',), lambda api_key: api_key)
+        self.assertEqual(len(switcher._ready_heaps), MoochSwitcher._MAX_KEY_SETS)
+    
+    def test_race_returns_first_success(self):
+        """Test that racing keys returns the first non-rate-limited response"""
+        switcher = MoochSwitcher(race=2)
+        
+        def call_func(api_key):
+            if api_key in ('key1', 'key3'):
+                raise self.rate_limit_error()
+            return api_key
+        
+        self.assertEqual(switcher._execute(('key1', 'key2', 'key3'), call_func), 'key2')
+        
+        async def acall_func(api_key):
+            return call_func(api_key)
+        
+        self.assertEqual(asyncio.run(switcher._aexecute(('key1', 'key3', 'key2'), acall_func)), 'key2')
+    
+    def test_race_skips_cooling_keys(self):
+        """Test that racing does not spend calls on keys known to be cooling down"""
+        switcher = MoochSwitcher(race=2, max_delay=0.5)
+        self.addCleanup(switcher.close)
+        calls = []
+        
+        def call_func(api_key):
+            calls.append(api_key)
+            raise self.rate_limit_error({'Retry-After': '3600'})
+        
+        for _ in range(3):
+            with self.assertRaises(AllKeysExhaustedError):
+                switcher._execute(('key1', 'key2'), call_func)
+        self.assertEqual(sorted(calls), ['key1', 'key2'])
+        
+        executor = switcher._race_executor
+        self.assertIs(switcher._race_executor, executor)
+        switcher.close()
+        self.assertIsNot(switcher._race_executor, executor)
+    
+    def test_cache_hits_deterministic_requests_only(self):
+        """Test that temperature=0 requests are served from the cache and others are not"""
+        switcher = MoochSwitcher(cache=LLMCache())
+        calls = []
+        
+        def create(**kwargs):
+            request = switcher._cache_request((), kwargs)
+            return switcher._execute(('key1',), lambda api_key: calls.append(api_key) or len(calls), request=request)
+        
+        messages = [{"role": "user", "content": "hi"}]
+        self.assertEqual(create(model='m', messages=messages, temperature=0), 1)
+        self.assertEqual(create(model='m', messages=messages, temperature=0), 1)
+        self.assertEqual(create(model='m', messages=messages, temperature=0, _no_cache=True), 2)
+        self.assertEqual(create(model='m', messages=messages, temperature=0.7), 3)
+        self.assertEqual(create(model='m', messages=messages, temperature=0.7), 4)
+        self.assertEqual(create(model='m', messages=messages, temperature=None), 5)
+        self.assertEqual(create(model='m', messages=messages, temperature=openai.NOT_GIVEN), 6)
+    
+    def test_redis_cache_stores_json(self):
+        """Test that Redis entries are JSON with whole-second expiry, and foreign payloads are not loaded"""
+        class FakeRedis:
+            def __init__(self):
+                self.data, self.ex = {}, None
+            
+            def get(self, key):
+                return self.data.get(key)
+            
+            def set(self, key, value, ex=None):
+                self.data[key], self.ex = value, ex
+        
+        redis = FakeRedis()
+        cache = LLMCache(ttl=1.5, redis=redis)
+        request = {'model': 'm', 'messages': [{'role': 'user', 'content': 'hi'}], 'temperature': 0}
+        response = ChatCompletion.model_validate({
+            'id': 'test', 'object': 'chat.completion', 'created': 0, 'model': 'm',
+            'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': 'ok'}}],
+        })
+        cache.set(request, response)
+        self.assertEqual(redis.ex, 2)
+        self.assertIsInstance(redis.ex, int)
+        self.assertEqual(cache.get(request), response)
+        
+        (key,) = redis.data
+        json.loads(redis.data[key])
+        redis.data[key] = json.dumps({'type': 'os:system', 'data': 'echo pwned'})
+        with self.assertLogs('mooch', level='WARNING'):
+            self.assertIsNone(cache.get(request))
+        
+        cache.set(request, 'not a response model')
+        self.assertEqual(len(redis.data), 1)
+    
+    def test_cache_is_scoped_per_endpoint(self):
+        """Test that wrappers sharing a switcher cache never serve each other's responses"""
+        base_a, methods_a = self.serve()
+        base_b, methods_b = self.serve()
+        switcher = MoochSwitcher(cache=LLMCache())
+        request = dict(model='test', messages=[{'role': 'user', 'content': 'hi'}], temperature=0)
+        
+        client_a = switcher(openai.OpenAI)(api_keys=['key1'], base_url=base_a, prewarm=False)
+        client_b = switcher(openai.OpenAI)(api_keys=['key1'], base_url=base_b, prewarm=False)
+        client_a.chat.completions.create(**request)
+        client_a.chat.completions.create(**request)
+        client_b.chat.completions.create(**request)
+        self.assertEqual((methods_a, methods_b), (['POST'], ['POST']))
+    
+    def test_semantic_cache_matches_similar_prompts(self):
+        """Test that the semantic L2 cache serves near-duplicate prompts of the same model"""
+        vectors = {"What is 2+2?": [1.0, 0.0], "what's 2 + 2": [0.95, 0.1], "Tell me a joke": [0.0, 1.0]}
+        cache = LLMCache(l2=SemanticLLMCache(vectors.__getitem__, threshold=0.85))
+        
+        def request(content, model='m', system="Answer in French", **kwargs):
+            messages = [{"role": "system", "content": system}, {"role": "user", "content": content}]
+            return {"model": model, "messages": messages, "temperature": 0, **kwargs}
+        
+        cache.set(request("What is 2+2?"), "4")
+        self.assertEqual(cache.get(request("what's 2 + 2")), "4")
+        self.assertIsNone(cache.get(request("Tell me a joke")))
+        self.assertIsNone(cache.get(request("what's 2 + 2", model='other')))
+        self.assertIsNone(cache.get(request("what's 2 + 2", system="Answer in German")))
+        self.assertIsNone(cache.get(request("what's 2 + 2", tools=[{"type": "function"}])))
+    
+    def test_semantic_cache_errors_are_misses(self):
+        """Test that a failing embedder does not fail the completion"""
+        def embedder(text):
+            raise openai.APIConnectionError(request=httpx.Request('POST', 'http://test'))
+        
+        switcher = MoochSwitcher(cache=LLMCache(l2=SemanticLLMCache(embedder)))
+        request = {"model": "m", "messages": [{"role": "user", "content": "hi"}], "temperature": 0}
+        with self.assertLogs('mooch', level='WARNING'):
+            self.assertEqual(switcher._execute(('key1',), lambda api_key: 'ok', request=request), 'ok')
+        self.assertEqual(switcher._execute(('key1',), lambda api_key: 'unused', request=request), 'ok')
+    
+    def test_factories_are_memoised_per_switcher(self):
+        """Test that wrapper factories are memoised on each switcher rather than in a class-wide cache"""
+        switcher, other = MoochSwitcher(), MoochSwitcher()
+        self.assertIs(switcher(openai.OpenAI), switcher(openai.OpenAI))
+        self.assertIsNot(switcher(openai.OpenAI), other(openai.OpenAI))
+        self.assertIs(switcher._factories[id(openai.OpenAI), False][1], switcher(openai.OpenAI))
+    
+    def test_async_cache_lookups_leave_the_event_loop(self):
+        """Test that the async path runs second-level lookups off the event loop thread and still hits"""
+        threads = []
+        
+        def embedder(text):
+            threads.append(threading.get_ident())
+            return [1.0, 0.0]
+        
+        switcher = MoochSwitcher(cache=LLMCache(l2=SemanticLLMCache(embedder)))
+        request = {"model": "m", "messages": [{"role": "user", "content": "hi"}], "temperature": 0}
+        calls = []
+        
+        async def call_func(api_key):
+            calls.append(api_key)
+            return 'ok'
+        
+        async def run():
+            first = await switcher._aexecute(('key1',), call_func, request=request)
+            other = dict(request, messages=[{"role": "user", "content": "hello"}])
+            return first, await switcher._aexecute(('key1',), call_func, request=other), threading.get_ident()
+        
+        first, second, loop_thread = asyncio.run(run())
+        self.assertEqual((first, second, calls), ('ok', 'ok', ['key1']))
+        self.assertNotIn(loop_thread, threads)
+    
+    def test_semantic_cache_needs_a_sync_client(self):
+        """Test that from_openai rejects async clients, whose embeddings call would never be awaited"""
+        with self.assertRaises(TypeError):
+            SemanticLLMCache.from_openai(mooch(openai.AsyncOpenAI)(api_keys=['key1']))
+    
+    def test_factories_can_be_pickled(self):
+        """Test that wrapper factories survive pickling (e.g. for multiprocessing) with their settings"""
+        factory = pickle.loads(pickle.dumps(MoochSwitcher(max_retries=5, race=2)(openai.OpenAI, verbose=True)))
+        client = factory(api_keys=['key1'], prewarm=False)
+        self.assertEqual((client.switcher.max_retries, client.switcher.race, client.verbose), (5, 2, True))
+    
+    def test_register_custom_target(self):
+        """Test that third-party targets can be registered with MoochSwitcher"""
+        def custom_target():
+            pass
+        
+        MoochSwitcher.register(custom_target, lambda switcher, verbose: (lambda api_keys: (api_keys, verbose)))
+        self.addCleanup(MoochSwitcher._DISPATCH.pop, id(custom_target))
+        self.assertEqual(MoochSwitcher()(custom_target, verbose=True)(['key1']), (['key1'], True))
+    
+    def test_async_switching(self):
+        """Test that the async path switches keys the same way as the sync one"""
+        switcher = MoochSwitcher(max_retries=1)
+        
+        async def call_func(api_key):
+            if api_key == 'key1':
+                raise self.rate_limit_error()
+            return api_key
+        
+        result = asyncio.run(switcher._aexecute(('key1', 'key2'), call_func))
+        self.assertEqual(result, 'key2')
+    
+    def test_prewarm_opens_a_connection(self):
+        """Test that pre-warming sends a HEAD to base_url and never raises"""
+        base_url, methods = self.serve()
+        switcher = MoochSwitcher()
+        self.addCleanup(switcher.close)
+        switcher(openai.OpenAI)(api_keys=['key1'], base_url=base_url)
+        deadline = time.monotonic() + 5
+        while not methods and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(methods, ['HEAD'])
+        
+        client = switcher(openai.OpenAI)(api_keys=['key1'], base_url=base_url, http_client=object(), prewarm=False)
+        client._prewarm()
+    
+    def test_async_wrapper_survives_new_event_loops(self):
+        """Test that pooled async connections are not reused across asyncio.run calls"""
+        base_url, _ = self.serve()
+        switcher = MoochSwitcher()
+        
+        async def complete():
+            client = switcher(openai.AsyncOpenAI)(api_keys=['key1'], base_url=base_url)
+            response = await client.chat.completions.create(model='test', messages=[{'role': 'user', 'content': 'hi'}])
+            return response.choices[0].message.content
+        
+        self.assertEqual(asyncio.run(complete()), 'ok')
+        self.assertEqual(asyncio.run(complete()), 'ok')
+    
+    def test_async_wrapper_creation(self):
+        """Test AsyncOpenAI and LiteLLM acompletion wrapper creation"""
+        client = mooch(openai.AsyncOpenAI)(api_keys=['key1', 'key2'])
+        self.assertTrue(asyncio.iscoroutinefunction(client.chat.completions.create))
+        
+        acompletion = mooch(litellm.acompletion)(api_keys=['key1', 'key2'])
+        self.assertTrue(asyncio.iscoroutinefunction(acompletion.__call__))
+    
+    def test_per_key_clients_are_reused(self):
+        """Test each key builds its OpenAI client once, until close()"""
+        client = mooch(openai.OpenAI)(api_keys=['key1', 'key2'], prewarm=False)
+        first = client._get_client('key1')
+        self.assertIs(client._get_client('key1'), first)
+        self.assertEqual(first.api_key, 'key1')
+        self.assertIsNot(client._get_client('key2'), first)
+        
+        client.close()
+        self.assertIsNot(client._get_client('key1'), first)
+    
+    def test_per_key_clients_share_the_switcher_pool(self):
+        """Test that every key uses the switcher's pool, which wrapper close() leaves open and switcher close() renews"""
+        switcher = MoochSwitcher()
+        self.addCleanup(switcher.close)
+        client = switcher(openai.OpenAI)(api_keys=['key1', 'key2'], prewarm=False)
+        pool = switcher.http_client
+        self.assertIs(client._get_client('key1')._client, pool)
+        self.assertIs(client._get_client('key2')._client, pool)
+        
+        client.close()
+        self.assertFalse(pool.is_closed)
+        
+        switcher.close()
+        self.assertTrue(pool.is_closed)
+        new_pool = client._get_client('key1')._client
+        self.assertIsNot(new_pool, pool)
+        self.assertFalse(new_pool.is_closed)
+
+
 if __name__ == '__main__':
     unittest.main() 
\ No newline at end of file
@@ -1,4 +1,6 @@
+import os
 from setuptools import setup, find_packages
+from setuptools.command.build_ext import build_ext
 
 
 LIBRARY_NAME = "mooch_switcher"
@@ -7,6 +9,36 @@ PACKAGE_DIR = 'mooch'
 with open('requirements.txt') as f:
     install_requires = f.read().splitlines()
 
+# Opt-in compiled build of the switching hot path: MOOCH_USE_MYPYC=1 pip install .
+ext_modules = []
+if os.environ.get('MOOCH_USE_MYPYC'):
+    try:
+        from mypyc.build import mypycify
+    except ImportError:
+        print("mypyc is not installed, installing the pure-Python version")
+    else:
+        try:
+            ext_modules = mypycify(['mooch/switcher.py', '--ignore-missing-imports'])
+        except (Exception, SystemExit) as e:
+            # mypycify exits on type-check errors (e.g. against other openai/httpx versions)
+            print(f"Could not compile with mypyc ({e!r}), installing the pure-Python version")
+
+
+class OptionalBuildExt(build_ext):
+    """Fall back to the pure-Python modules when the C extension cannot be built"""
+
+    def run(self):
+        try:
+            super().run()
+        except Exception as e:
+            print(f"Could not compile C extensions ({e}), installing the pure-Python version")
+
+    def build_extension(self, ext):
+        try:
+            super().build_extension(ext)
+        except Exception as e:
+            print(f"Could not compile {ext.name} ({e}), installing the pure-Python version")
+
 setup(
     name=LIBRARY_NAME,
     version="0.1.0",
@@ -14,6 +46,8 @@ setup(
     # packages=find_packages(PACKAGE_DIR),
     packages=find_packages(),
     install_requires=install_requires,
+    ext_modules=ext_modules,
+    cmdclass={"build_ext": OptionalBuildExt},
     author="kenyo3026",
     author_email="kenyo3026@gmail.com",
     description="🔄 Mooch Switch - Get the most out of your free-tier API keys with automatic switching on rate limits",